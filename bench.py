@@ -0,0 +1,405 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import random
+import posixpath
+import paramiko
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from paramiko import SFTPServer, SFTPServerInterface, SFTPAttributes, SFTPHandle, SFTP_OK
+
+from xpftp import SFTPClient, ConnectionPool, TransferJournal, HashCache, parse_tuning
+
+SCENARIOS = ['huge-file', 'tiny-files', 'deep-tree', 'big-listing', 'log-files']
+
+# ---------------- In-process SFTP Server ----------------
+class BenchServer(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+def set_file_attr(path, attr):
+    # SFTPServer.set_file_attr changes the size by reopening the file with
+    # "w+", which throws its contents away; resumed uploads and remote
+    # preallocation need the data kept
+    flags = attr._flags
+    if flags & attr.FLAG_PERMISSIONS:
+        os.chmod(path, attr.st_mode)
+    if flags & attr.FLAG_UIDGID:
+        os.chown(path, attr.st_uid, attr.st_gid)
+    if flags & attr.FLAG_AMTIME:
+        os.utime(path, (attr.st_atime, attr.st_mtime))
+    if flags & attr.FLAG_SIZE:
+        with open(path, 'r+b') as f:
+            f.truncate(attr.st_size)
+
+class BenchHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+# Serves a local directory; every path is taken relative to ROOT
+class BenchSFTP(SFTPServerInterface):
+    ROOT = None
+
+    def _local(self, path):
+        return os.path.join(self.ROOT, *self.canonicalize(path).split('/'))
+
+    def canonicalize(self, path):
+        return posixpath.normpath('/' + path)
+
+    def list_folder(self, path):
+        local = self._local(path)
+        try:
+            out = []
+            for name in os.listdir(local):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(local, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        local = self._local(path)
+        try:
+            fd = os.open(local, flags | getattr(os, 'O_BINARY', 0), 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = BenchHandle(flags)
+        handle.filename = local
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def remove(self, path):
+        return self._call(os.remove, self._local(path))
+
+    def rename(self, old_path, new_path):
+        return self._call(os.rename, self._local(old_path), self._local(new_path))
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self._local(path))
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self._local(path))
+
+    def chattr(self, path, attr):
+        return self._call(set_file_attr, self._local(path), attr)
+
+def start_server(root):
+    BenchSFTP.ROOT = root
+    key = paramiko.RSAKey.generate(2048)
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+
+    def accept():
+        while True:
+            conn, addr = sock.accept()
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(key)
+            transport.use_compression(True)
+            transport.set_subsystem_handler('sftp', SFTPServer, BenchSFTP)
+            transport.start_server(server=BenchServer())
+
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+    return sock.getsockname()[1]
+
+# ---------------- Link Shaping ----------------
+# Loopback TCP relay that adds a round-trip delay and an optional bandwidth
+# cap (bytes/s) per direction in front of the server
+class ShapingProxy(object):
+    def __init__(self, target_port, latency=0.0, bandwidth=None):
+        self.target_port = target_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self._thread(self._accept)
+
+    def _thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            client, addr = self.sock.accept()
+            server = socket.create_connection(('127.0.0.1', self.target_port))
+            for src, dst in ((client, server), (server, client)):
+                pending = queue.Queue()
+                self._thread(self._read, src, pending)
+                self._thread(self._write, dst, pending)
+
+    def _read(self, src, pending):
+        free_at = 0.0
+        while True:
+            data = src.recv(65536)
+            if not data:
+                pending.put(None)
+                return
+            now = time.time()
+            if self.bandwidth:
+                free_at = max(now, free_at) + len(data) / float(self.bandwidth)
+            else:
+                free_at = now
+            pending.put((free_at + self.latency / 2.0, data))
+
+    def _write(self, dst, pending):
+        while True:
+            item = pending.get()
+            if item is None:
+                dst.shutdown(socket.SHUT_WR)
+                return
+            due, data = item
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            dst.sendall(data)
+
+# ---------------- Scenarios ----------------
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def result(scenario, operation, seconds, files, nbytes, latencies=None):
+    out = {
+        'scenario': scenario,
+        'operation': operation,
+        'seconds': round(seconds, 4),
+        'files': files,
+        'bytes': nbytes,
+        'files_per_s': round(files / seconds, 2) if seconds else None,
+        'mb_per_s': round(nbytes / seconds / 1048576.0, 3) if seconds else None,
+    }
+    if latencies:
+        out['p50_ms'] = round(percentile(latencies, 0.5) * 1000, 3)
+        out['p99_ms'] = round(percentile(latencies, 0.99) * 1000, 3)
+    return out
+
+def timed(func, *args):
+    started = time.time()
+    func(*args)
+    return time.time() - started
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        while size > 0:
+            block = os.urandom(min(size, 1048576))
+            f.write(block)
+            size -= len(block)
+
+def write_log(path, size):
+    # Log-like text, compresses about as well as real service logs
+    levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARN', 'ERROR']
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            line = '2024-05-{0:02d}T{1:02d}:{2:02d}:{3:02d}.{4:03d} {5} worker-{6} request id={7:08x} status={8} bytes={9}\n'.format(
+                random.randint(1, 28), random.randint(0, 23), random.randint(0, 59), random.randint(0, 59),
+                random.randint(0, 999), random.choice(levels), random.randint(1, 16), random.getrandbits(32),
+                random.choice([200, 200, 200, 304, 404, 500]), random.randint(0, 100000)).encode('ascii')
+            f.write(line)
+            written += len(line)
+
+def make_tree(root, depth, fanout, files, size):
+    # Returns (file count, byte count)
+    os.makedirs(root)
+    count = 0
+    for i in range(files):
+        write_file(os.path.join(root, 'f{0}.dat'.format(i)), size)
+        count += 1
+    if depth > 0:
+        for i in range(fanout):
+            count += make_tree(os.path.join(root, 'd{0}'.format(i)), depth - 1, fanout, files, size)[0]
+    return count, count * size
+
+def per_file_latencies(client, local_dir, remote_dir, sample):
+    # Sequential single-file round trips: upload then download each file
+    names = sorted(os.listdir(local_dir))[:sample]
+    up, down = [], []
+    for name in names:
+        up.append(timed(client.upload, os.path.join(local_dir, name), remote_dir + '/' + name))
+    for name in names:
+        down.append(timed(client.download, remote_dir + '/' + name, os.path.join(local_dir, name + '.back')))
+    return up, down
+
+def run_scenario(name, client, local, remote_root, args):
+    results = []
+    src = os.path.join(local, name)
+    back = os.path.join(local, name + '-back')
+    remote = '/' + name
+    if name == 'huge-file':
+        size = args.huge_mb * 1048576
+        os.makedirs(src)
+        write_file(os.path.join(src, 'huge.dat'), size)
+        client.mkdir(remote)
+        seconds = timed(client.upload, os.path.join(src, 'huge.dat'), remote + '/huge.dat')
+        results.append(result(name, 'upload', seconds, 1, size))
+        seconds = timed(client.download, remote + '/huge.dat', os.path.join(src, 'huge.back'))
+        results.append(result(name, 'download', seconds, 1, size))
+    elif name in ('tiny-files', 'deep-tree'):
+        if name == 'tiny-files':
+            files, nbytes = make_tree(src, 0, 0, args.tiny_files, args.tiny_size)
+        else:
+            files, nbytes = make_tree(src, args.depth, args.fanout, args.files_per_dir, args.tiny_size)
+        seconds = timed(client.upload, src, remote)
+        results.append(result(name, 'upload_dir', seconds, files, nbytes))
+        seconds = timed(client.download, remote, back)
+        results.append(result(name, 'download_dir', seconds, files, nbytes))
+        if name == 'tiny-files':
+            up, down = per_file_latencies(client, src, remote, args.sample)
+            results.append(result(name, 'upload', sum(up), len(up), len(up) * args.tiny_size, up))
+            results.append(result(name, 'download', sum(down), len(down), len(down) * args.tiny_size, down))
+    elif name == 'big-listing':
+        # Created straight on the server's disk, only the listing is measured
+        os.makedirs(os.path.join(remote_root, name))
+        for i in range(args.listing_entries):
+            open(os.path.join(remote_root, name, 'e{0:06d}'.format(i)), 'wb').close()
+        seconds = timed(client.listdir_attr, remote, True)
+        results.append(result(name, 'listdir_attr', seconds, args.listing_entries, 0))
+        started = time.time()
+        first = None
+        for item in client.listdir_iter(remote, True):
+            if first is None:
+                first = time.time() - started
+        seconds = time.time() - started
+        results.append(result(name, 'listdir_iter', seconds, args.listing_entries, 0, [first]))
+    elif name == 'log-files':
+        size = args.log_mb * 1048576
+        os.makedirs(src)
+        for i in range(args.log_files):
+            write_log(os.path.join(src, 'service{0}.log'.format(i)), size)
+        seconds = timed(client.upload, src, remote)
+        results.append(result(name, 'upload', seconds, args.log_files, args.log_files * size))
+        seconds = timed(client.download, remote, back)
+        results.append(result(name, 'download', seconds, args.log_files, args.log_files * size))
+    return results
+
+# ---------------- Run ----------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Throughput benchmark against an in-process SFTP server.')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='repeatable, default all')
+    parser.add_argument('--latency', type=float, default=0.0, help='added round-trip time in ms')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='link cap in MB/s per direction, 0 = none')
+    parser.add_argument('--channels', type=int, default=None)
+    parser.add_argument('--segments', type=int, default=None)
+    parser.add_argument('--auto-tune', action='store_true', help='probe the link at connect, as the client option')
+    parser.add_argument('--tune', action='append', metavar='KEY=N', help='transport setting, as the client option')
+    parser.add_argument('--huge-mb', type=int, default=256)
+    parser.add_argument('--tiny-files', type=int, default=10000)
+    parser.add_argument('--tiny-size', type=int, default=1024)
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--files-per-dir', type=int, default=4)
+    parser.add_argument('--listing-entries', type=int, default=50000)
+    parser.add_argument('--log-files', type=int, default=16)
+    parser.add_argument('--log-mb', type=int, default=4, help='size of each log file')
+    parser.add_argument('--compression', choices=['off', 'on', 'auto'], default='off')
+    parser.add_argument('--sample', type=int, default=200, help='files timed one by one for latency percentiles')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+    tuning = parse_tuning(args.tune)
+    if args.auto_tune:
+        tuning['auto'] = True
+    tuning['compression'] = {'off': False, 'on': True, 'auto': 'auto'}[args.compression]
+
+    workdir = tempfile.mkdtemp(prefix='xpftp-bench-')
+    remote_root = os.path.join(workdir, 'server')
+    local = os.path.join(workdir, 'client')
+    os.makedirs(remote_root)
+    os.makedirs(local)
+    try:
+        port = start_server(remote_root)
+        if args.latency or args.bandwidth:
+            port = ShapingProxy(port, args.latency / 1000.0, args.bandwidth * 1048576 or None).port
+        client = SFTPClient(pool=ConnectionPool())
+        client.journal = TransferJournal(os.path.join(workdir, 'transfers.json'))
+        client.hash_cache = HashCache(os.path.join(workdir, 'hashes.json'))
+        if args.channels:
+            client.channels = args.channels
+        if args.segments:
+            client.segments = args.segments
+        started = time.time()
+        client.connect('127.0.0.1', port, 'bench', 'bench', tuning)
+        results = [result('connect', 'handshake', time.time() - started, 0, 0)]
+        tuned = client.tuning
+        for name in args.scenario or SCENARIOS:
+            results.extend(run_scenario(name, client, local, remote_root, args))
+        client.close()
+        client.pool.close_all()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'config': dict((k, v) for k, v in vars(args).items() if k != 'output'),
+        'python': sys.version.split()[0],
+        'paramiko': paramiko.__version__,
+        'tuning': tuned,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
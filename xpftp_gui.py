@@ -0,0 +1,1075 @@
+import os
+import stat
+import time
+import shutil
+
+from PyQt4 import QtGui, QtCore
+
+from xpftp import (SFTPClient, TransferCancelled, connection_pool, format_size, format_duration,
+                   load_profiles, save_profiles, DEFAULT_VERIFY, ProgressMeter, metrics, instrumented,
+                   MAX_CHANNELS_PER_HOST, BROWSE_CHANNELS)
+
+DEFAULT_ACTIVE_TRANSFERS = 2
+FETCH_BATCH = 1000
+LIST_PAGE = 500
+COMPRESSION_MODES = [False, True, 'auto']
+DEBUG_REFRESH_MS = 1000
+
+# ---------------- File List Model ----------------
+class FileEntry(object):
+    __slots__ = ('name', 'size', 'mtime', 'is_dir')
+
+    def __init__(self, name, size, mtime, is_dir):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.is_dir = is_dir
+
+UP_ENTRY = FileEntry('..', 0, None, True)
+
+# Flat model over a list of FileEntry records. Rows are exposed in batches
+# through canFetchMore/fetchMore so the view only lays out what it scrolls
+# to, and cell text is formatted on demand. Directories always sort first,
+# '..' stays on top.
+class FileListModel(QtCore.QAbstractTableModel):
+    HEADERS = ['Name', 'Size', 'Modified']
+
+    def __init__(self, dir_icon, file_icon, parent=None):
+        super(FileListModel, self).__init__(parent)
+        self.dir_icon = dir_icon
+        self.file_icon = file_icon
+        self.entries = []
+        self.loaded = 0
+        self.sort_column = 0
+        self.sort_order = QtCore.Qt.AscendingOrder
+
+    def set_entries(self, entries, with_parent=False):
+        self.beginResetModel()
+        self._sort(entries)
+        self.entries = ([UP_ENTRY] if with_parent else []) + entries
+        self.loaded = min(FETCH_BATCH, len(self.entries))
+        self.endResetModel()
+
+    def extend(self, entries):
+        # Streamed rows arrive unsorted; callers sort() once the stream ends
+        self.entries.extend(entries)
+        if self.loaded < FETCH_BATCH:
+            self.fetchMore(QtCore.QModelIndex())
+
+    def entry(self, index):
+        if index.isValid() and index.row() < self.loaded:
+            return self.entries[index.row()]
+        return None
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.loaded
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.loaded < len(self.entries)
+
+    def fetchMore(self, parent):
+        count = min(FETCH_BATCH, len(self.entries) - self.loaded)
+        if parent.isValid() or count <= 0:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), self.loaded, self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        entry = self.entry(index)
+        if entry is None:
+            return None
+        column = index.column()
+        if role == QtCore.Qt.DisplayRole:
+            if column == 0:
+                return entry.name
+            if column == 1:
+                return '' if entry.is_dir else format_size(entry.size or 0)
+            return time.ctime(entry.mtime) if entry.mtime is not None else ''
+        if role == QtCore.Qt.DecorationRole and column == 0:
+            return self.dir_icon if entry.is_dir else self.file_icon
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return QtCore.Qt.ItemIsEnabled
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsDragEnabled
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        self.sort_column = column
+        self.sort_order = order
+        self.layoutAboutToBeChanged.emit()
+        has_parent = bool(self.entries) and self.entries[0] is UP_ENTRY
+        rest = self.entries[1:] if has_parent else self.entries
+        self._sort(rest)
+        self.entries = ([UP_ENTRY] if has_parent else []) + rest
+        self.layoutChanged.emit()
+
+    def _sort(self, entries):
+        if self.sort_column == 1:
+            key = lambda e: e.size or 0
+        elif self.sort_column == 2:
+            key = lambda e: e.mtime or 0
+        else:
+            key = lambda e: e.name.lower()
+        entries.sort(key=key, reverse=self.sort_order == QtCore.Qt.DescendingOrder)
+        entries.sort(key=lambda e: not e.is_dir)
+
+# ---------------- Drag-and-Drop Trees ----------------
+class FileTree(QtGui.QTreeView):
+    def __init__(self, parent=None):
+        super(FileTree, self).__init__(parent)
+        self.parent_window = parent
+        self.setDragEnabled(True)
+        self.setAcceptDrops(True)
+        self.setDefaultDropAction(QtCore.Qt.CopyAction)
+        self.setRootIsDecorated(False)
+        self.setUniformRowHeights(True)
+        self.setAllColumnsShowFocus(True)
+        style = parent.style()
+        self.setModel(FileListModel(style.standardIcon(QtGui.QStyle.SP_DirIcon),
+                                    style.standardIcon(QtGui.QStyle.SP_FileIcon), self))
+        self.setSortingEnabled(True)
+        self.sortByColumn(0, QtCore.Qt.AscendingOrder)
+
+    def current_entry(self):
+        return self.model().entry(self.currentIndex())
+
+    def entry_at(self, pos):
+        return self.model().entry(self.indexAt(pos))
+
+    def dragEnterEvent(self, event):
+        if event.mimeData().hasText():
+            event.acceptProposedAction()
+        else:
+            event.ignore()
+
+    def dragMoveEvent(self, event):
+        if event.mimeData().hasText():
+            event.acceptProposedAction()
+        else:
+            event.ignore()
+
+class LocalTree(FileTree):
+    def startDrag(self, dropActions):
+        item = self.current_entry()
+        if item and item.name != '..':
+            path = os.path.join(self.parent_window.local_path, item.name)
+            mime = QtCore.QMimeData()
+            mime.setText(path)
+            drag = QtGui.QDrag(self)
+            drag.setMimeData(mime)
+            drag.exec_(QtCore.Qt.CopyAction)
+
+    def dropEvent(self, event):
+        source_path = str(event.mimeData().text())
+        local_dest = os.path.join(self.parent_window.local_path, os.path.basename(source_path))
+        if os.path.abspath(source_path) == os.path.abspath(local_dest):
+            event.ignore()
+            return
+        self.parent_window.transfer_queue.enqueue('download', (source_path, local_dest),
+                                                  'Download ' + source_path, 'local')
+        event.acceptProposedAction()
+
+class RemoteTree(FileTree):
+    def startDrag(self, dropActions):
+        item = self.current_entry()
+        if item and item.name != '..':
+            path = self.parent_window.remote_path + '/' + item.name
+            mime = QtCore.QMimeData()
+            mime.setText(path)
+            drag = QtGui.QDrag(self)
+            drag.setMimeData(mime)
+            drag.exec_(QtCore.Qt.CopyAction)
+
+    def dropEvent(self, event):
+        source_path = str(event.mimeData().text())
+        remote_dest = self.parent_window.remote_path + '/' + os.path.basename(source_path)
+        if source_path == remote_dest:
+            event.ignore()
+            return
+        self.parent_window.transfer_queue.enqueue('upload', (source_path, remote_dest),
+                                                  'Upload ' + source_path, 'remote')
+        event.acceptProposedAction()
+
+# ---------------- Transfer Queue ----------------
+class QueuedTransfer(object):
+    def __init__(self, job_id, method, args, label, refresh, unit='bytes'):
+        self.id = job_id
+        self.method = method
+        self.args = args
+        self.label = label
+        self.refresh = refresh
+        self.unit = unit
+        self.status = 'Pending'
+        self.stop_reason = None
+        self.thread = None
+        self.item = None
+        # What the method returned, or the error it failed with
+        self.result = None
+        self.error = None
+
+class TransferThread(QtCore.QThread):
+    progress = QtCore.pyqtSignal(object, object)
+    done = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, client, task, parent=None):
+        super(TransferThread, self).__init__(parent)
+        self.client = client
+        self.task = task
+
+    def run(self):
+        task = self.task
+
+        def report(meter):
+            if task.stop_reason:
+                raise TransferCancelled(task.stop_reason)
+            # A plain copy, the meter moves on while the GUI thread reads it
+            self.progress.emit(task.id, dict(done=meter.done, total=meter.total, files_done=meter.files_done,
+                                             files_total=meter.files_total, rate=meter.rate(),
+                                             file_rate=meter.file_rate(), eta=meter.eta()))
+
+        error = None
+        try:
+            client = self.client.clone()
+            meter = ProgressMeter(report)
+            try:
+                # Tasks without a unit (sync plans) have no progress to show
+                if task.unit:
+                    task.result = getattr(client, task.method)(*task.args, progress_callback=meter)
+                    meter.finish()
+                else:
+                    task.result = getattr(client, task.method)(*task.args)
+            finally:
+                client.close()
+        except TransferCancelled:
+            pass
+        except Exception as e:
+            error = str(e)
+        self.done.emit(task.id, error)
+
+class TransferQueue(QtGui.QWidget):
+    job_finished = QtCore.pyqtSignal(object)
+    limits_changed = QtCore.pyqtSignal()
+
+    def __init__(self, parent=None):
+        super(TransferQueue, self).__init__(parent)
+        self.parent_window = parent
+        self.tasks = []
+        self.next_id = 1
+        self.max_active = DEFAULT_ACTIVE_TRANSFERS
+
+        layout = QtGui.QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.tree = QtGui.QTreeWidget()
+        self.tree.setColumnCount(5)
+        self.tree.setHeaderLabels(['Transfer', 'Status', 'Progress', 'Speed', 'ETA'])
+        self.tree.setRootIsDecorated(False)
+        layout.addWidget(self.tree)
+
+        buttons = QtGui.QHBoxLayout()
+        self.pause_btn = QtGui.QPushButton('Pause')
+        self.resume_btn = QtGui.QPushButton('Resume')
+        self.cancel_btn = QtGui.QPushButton('Cancel')
+        self.up_btn = QtGui.QPushButton('Move Up')
+        self.down_btn = QtGui.QPushButton('Move Down')
+        self.clear_btn = QtGui.QPushButton('Clear Finished')
+        self.active_spin = QtGui.QSpinBox()
+        # Each transfer needs a channel of its own besides those kept for browsing
+        self.active_spin.setRange(1, MAX_CHANNELS_PER_HOST - BROWSE_CHANNELS)
+        self.active_spin.setValue(self.max_active)
+        # KB/s caps shared by all transfers; 0 leaves the profile's setting
+        self.limit_spins = {}
+        for key in ('up', 'down'):
+            spin = self.limit_spins[key] = QtGui.QSpinBox()
+            spin.setRange(0, 1024 * 1024)
+            spin.setSingleStep(64)
+            spin.setSpecialValueText('Profile')
+            spin.setSuffix(' KB/s')
+        for btn in (self.pause_btn, self.resume_btn, self.cancel_btn, self.up_btn, self.down_btn, self.clear_btn):
+            buttons.addWidget(btn)
+        buttons.addStretch()
+        buttons.addWidget(QtGui.QLabel('Parallel transfers'))
+        buttons.addWidget(self.active_spin)
+        buttons.addWidget(QtGui.QLabel('Up'))
+        buttons.addWidget(self.limit_spins['up'])
+        buttons.addWidget(QtGui.QLabel('Down'))
+        buttons.addWidget(self.limit_spins['down'])
+        layout.addLayout(buttons)
+
+        self.pause_btn.clicked.connect(self.pause_selected)
+        self.resume_btn.clicked.connect(self.resume_selected)
+        self.cancel_btn.clicked.connect(self.cancel_selected)
+        self.up_btn.clicked.connect(lambda: self.move_selected(-1))
+        self.down_btn.clicked.connect(lambda: self.move_selected(1))
+        self.clear_btn.clicked.connect(self.clear_finished)
+        self.active_spin.valueChanged.connect(self.set_max_active)
+        for spin in self.limit_spins.values():
+            spin.valueChanged.connect(lambda value: self.limits_changed.emit())
+
+    def enqueue(self, method, args, label, refresh, unit='bytes'):
+        # unit: what progress counts, 'bytes' or 'entries' for bulk operations,
+        # None for none
+        task = QueuedTransfer(self.next_id, method, args, label, refresh, unit)
+        self.next_id += 1
+        task.item = QtGui.QTreeWidgetItem([label, task.status, '', '', ''])
+        self.tasks.append(task)
+        self.tree.addTopLevelItem(task.item)
+        self.schedule()
+        return task
+
+    def schedule(self):
+        active = len([t for t in self.tasks if t.status == 'Active'])
+        for task in self.tasks:
+            if active >= self.max_active:
+                break
+            if task.status == 'Pending':
+                self._start(task)
+                active += 1
+
+    def _start(self, task):
+        task.status = 'Active'
+        task.stop_reason = None
+        task.error = None
+        task.item.setText(1, task.status)
+        task.thread = TransferThread(self.parent_window.sftp, task, self)
+        task.thread.progress.connect(self._on_progress)
+        task.thread.done.connect(self._on_done)
+        task.thread.start()
+
+    def _task(self, job_id):
+        for task in self.tasks:
+            if task.id == job_id:
+                return task
+
+    def _on_progress(self, job_id, progress):
+        # At most a few times a second per task, see ProgressMeter
+        task = self._task(job_id)
+        if task.unit == 'bytes':
+            text = '{0} / {1}'.format(format_size(progress['done']), format_size(progress['total']))
+            speed = format_size(progress['rate']) + '/s'
+        else:
+            text = '{0} / {1}'.format(progress['done'], progress['total'])
+            speed = '{0:.0f} {1}/s'.format(progress['rate'], task.unit)
+        if progress['files_total'] > 1:
+            text += ', {0} / {1} files'.format(progress['files_done'], progress['files_total'])
+            speed += ', {0:.1f} files/s'.format(progress['file_rate'])
+        task.item.setText(2, text)
+        task.item.setText(3, speed if progress['rate'] > 0 else '')
+        task.item.setText(4, format_duration(progress['eta']) if progress['eta'] is not None else '')
+
+    def _on_done(self, job_id, error):
+        task = self._task(job_id)
+        task.thread.wait()
+        task.thread = None
+        if task.stop_reason == 'pause':
+            task.status = 'Paused'
+        elif task.stop_reason == 'cancel':
+            task.status = 'Cancelled'
+        elif error:
+            task.status = 'Failed'
+            task.error = error
+            task.item.setToolTip(1, error)
+        else:
+            task.status = 'Done'
+        task.item.setText(1, task.status)
+        task.item.setText(3, '')
+        task.item.setText(4, '')
+        if task.status in ('Done', 'Failed'):
+            self.job_finished.emit(task)
+        self.schedule()
+
+    def selected(self):
+        item = self.tree.currentItem()
+        for task in self.tasks:
+            if task.item is item:
+                return task
+
+    def pause_selected(self):
+        task = self.selected()
+        if task and task.status == 'Active':
+            task.stop_reason = 'pause'
+        elif task and task.status == 'Pending':
+            task.status = 'Paused'
+            task.item.setText(1, task.status)
+
+    def resume_selected(self):
+        task = self.selected()
+        if task and task.status in ('Paused', 'Failed', 'Cancelled'):
+            # The transfer journal lets the restarted job skip what is done
+            task.status = 'Pending'
+            task.item.setText(1, task.status)
+            self.schedule()
+
+    def cancel_selected(self):
+        task = self.selected()
+        if task and task.status == 'Active':
+            task.stop_reason = 'cancel'
+        elif task and task.status in ('Pending', 'Paused'):
+            task.status = 'Cancelled'
+            task.item.setText(1, task.status)
+
+    def move_selected(self, step):
+        task = self.selected()
+        if not task:
+            return
+        index = self.tasks.index(task)
+        target = index + step
+        if target < 0 or target >= len(self.tasks):
+            return
+        self.tasks.insert(target, self.tasks.pop(index))
+        self.tree.insertTopLevelItem(target, self.tree.takeTopLevelItem(index))
+        self.tree.setCurrentItem(task.item)
+
+    def clear_finished(self):
+        for task in list(self.tasks):
+            if task.status in ('Done', 'Cancelled'):
+                self.tasks.remove(task)
+                self.tree.takeTopLevelItem(self.tree.indexOfTopLevelItem(task.item))
+
+    def set_max_active(self, value):
+        self.max_active = value
+        self.schedule()
+
+    def limits(self):
+        # Bytes/s overrides from the limit boxes
+        return dict((key, spin.value() * 1024) for key, spin in self.limit_spins.items() if spin.value())
+
+    def shutdown(self):
+        for task in self.tasks:
+            if task.thread:
+                task.stop_reason = 'cancel'
+        for task in self.tasks:
+            if task.thread:
+                task.thread.wait()
+
+# ---------------- Listing ----------------
+# Streams a directory listing in pages from anything with
+# listdir_iter(path, refresh): an SFTPClient, or a LocalCache for the
+# local side. op names the listing in the metrics.
+class ListingThread(QtCore.QThread):
+    page = QtCore.pyqtSignal(object, object)
+    done = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, client, path, refresh, show_hidden, generation, parent=None, op='ui.listing'):
+        super(ListingThread, self).__init__(parent)
+        self.client = client
+        self.op = op
+        self.path = path
+        self.refresh = refresh
+        self.show_hidden = show_hidden
+        self.generation = generation
+        self.cancelled = False
+
+    def run(self):
+        batch = []
+        started = last = time.time()
+        count = 0
+        error = None
+        try:
+            # A cancelled listing is still read to the end so its channel is
+            # left clean and the result lands in the cache
+            for f in self.client.listdir_iter(self.path, refresh=self.refresh):
+                if self.cancelled or (not self.show_hidden and f.filename.startswith('.')):
+                    continue
+                batch.append(FileEntry(f.filename, f.st_size, f.st_mtime, stat.S_ISDIR(f.st_mode)))
+                count += 1
+                if len(batch) >= LIST_PAGE or time.time() - last > 0.1:
+                    self.page.emit(self.generation, batch)
+                    batch = []
+                    last = time.time()
+            if batch and not self.cancelled:
+                self.page.emit(self.generation, batch)
+        except Exception as e:
+            error = str(e)
+        # From the click to the last entry, as the user waits for it
+        metrics.observe(self.op, time.time() - started, error=error, path=self.path, entries=count)
+        self.done.emit(self.generation, error)
+
+# ---------------- Debug Panel ----------------
+# Live view of the instrumentation in xpftp.metrics, refreshed while shown
+class DebugPanel(QtGui.QWidget):
+    COLUMNS = ['Operation', 'Calls', 'Errors', 'p50 ms', 'p90 ms', 'p99 ms', 'Max ms', 'Throughput']
+
+    def __init__(self, parent=None):
+        super(DebugPanel, self).__init__(parent, QtCore.Qt.Window)
+        self.setWindowTitle('Debug')
+        self.resize(700, 400)
+        layout = QtGui.QVBoxLayout(self)
+        self.uptime_label = QtGui.QLabel()
+        self.tree = QtGui.QTreeWidget()
+        self.tree.setColumnCount(len(self.COLUMNS))
+        self.tree.setHeaderLabels(self.COLUMNS)
+        self.tree.setRootIsDecorated(False)
+        layout.addWidget(self.uptime_label)
+        layout.addWidget(self.tree)
+
+        buttons = QtGui.QHBoxLayout()
+        self.trace_btn = QtGui.QPushButton('Trace to File...')
+        self.reset_btn = QtGui.QPushButton('Reset')
+        buttons.addWidget(self.trace_btn)
+        buttons.addWidget(self.reset_btn)
+        buttons.addStretch()
+        layout.addLayout(buttons)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(DEBUG_REFRESH_MS)
+        self.timer.timeout.connect(self.refresh)
+        self.trace_btn.clicked.connect(self.toggle_trace)
+        self.reset_btn.clicked.connect(self.reset)
+        self.update_trace_button()
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        super(DebugPanel, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super(DebugPanel, self).hideEvent(event)
+
+    def refresh(self):
+        snapshot = metrics.snapshot()
+        self.uptime_label.setText('Collecting for ' + format_duration(snapshot['uptime']))
+        self.tree.clear()
+        for op, s in sorted(snapshot['ops'].items()):
+            self.tree.addTopLevelItem(QtGui.QTreeWidgetItem([
+                op, str(s['calls']), str(s['errors'])] + ['{0:.1f}'.format(s[key] * 1000) for key in
+                                                         ('p50', 'p90', 'p99', 'max')] +
+                [format_size(s['throughput']) + '/s' if s['throughput'] else '']))
+        for name, value in sorted(snapshot['counters'].items()):
+            self.tree.addTopLevelItem(QtGui.QTreeWidgetItem([name, str(value)]))
+
+    def reset(self):
+        metrics.reset()
+        self.refresh()
+
+    def toggle_trace(self):
+        if metrics.trace is not None:
+            metrics.trace_to(None)
+        else:
+            path = QtGui.QFileDialog.getSaveFileName(self, 'Trace to File', 'trace.jsonl')
+            if path:
+                metrics.trace_to(str(path))
+        self.update_trace_button()
+
+    def update_trace_button(self):
+        self.trace_btn.setText('Stop Trace' if metrics.trace is not None else 'Trace to File...')
+
+# ---------------- Main Window ----------------
+class MainWindow(QtGui.QWidget):
+    def __init__(self):
+        super(MainWindow, self).__init__()
+        self.setWindowTitle('SFTP Client for Windows XP :D')
+        self.resize(1000, 600)
+
+        self.sftp = SFTPClient()
+        self.profiles = load_profiles()
+        self.local_path = os.path.expanduser("~")
+        self.remote_path = "."
+        self.show_hidden = False
+        self.connected = False
+        self.listing = None
+        self.listing_generation = 0
+        self.idle_lister = None
+        self.local_listing = None
+        self.local_generation = 0
+
+        layout = QtGui.QVBoxLayout(self)
+
+        # Top controls
+        top_layout = QtGui.QHBoxLayout()
+        self.profile_box = QtGui.QComboBox()
+        self.profile_box.addItems(list(self.profiles.keys()))
+        self.host_edit = QtGui.QLineEdit()
+        self.user_edit = QtGui.QLineEdit()
+        self.pass_edit = QtGui.QLineEdit()
+        self.pass_edit.setEchoMode(QtGui.QLineEdit.Password)
+        self.auto_tune_cb = QtGui.QCheckBox('Auto-tune')
+        self.auto_tune_cb.setToolTip('Measure the link when connecting and size transfer windows to it')
+        self.compression_box = QtGui.QComboBox()
+        self.compression_box.addItems(['Off', 'On', 'Auto'])
+        self.compression_box.setToolTip('SSH compression; Auto compresses only files that sample as compressible')
+        self.verify_cb = QtGui.QCheckBox('Verify')
+        self.verify_cb.setToolTip('Check every transferred file against a hash computed by the server; '
+                                  'servers without check-file, such as OpenSSH, need Run commands')
+        self.exec_cb = QtGui.QCheckBox('Run commands')
+        self.exec_cb.setToolTip('Allow shell commands on the server: hashing for Verify, fast deletes '
+                                'and tar transfers of directories')
+        self.connect_btn = QtGui.QPushButton('Connect')
+        self.save_profile_btn = QtGui.QPushButton('Save Profile')
+
+        top_layout.addWidget(QtGui.QLabel('Profile'))
+        top_layout.addWidget(self.profile_box)
+        top_layout.addWidget(QtGui.QLabel('Host'))
+        top_layout.addWidget(self.host_edit)
+        top_layout.addWidget(QtGui.QLabel('User'))
+        top_layout.addWidget(self.user_edit)
+        top_layout.addWidget(QtGui.QLabel('Password'))
+        top_layout.addWidget(self.pass_edit)
+        top_layout.addWidget(self.auto_tune_cb)
+        top_layout.addWidget(QtGui.QLabel('Compression'))
+        top_layout.addWidget(self.compression_box)
+        top_layout.addWidget(self.verify_cb)
+        top_layout.addWidget(self.exec_cb)
+        top_layout.addWidget(self.connect_btn)
+        top_layout.addWidget(self.save_profile_btn)
+
+        layout.addLayout(top_layout)
+
+        # hidden + refresh icon
+        bottom_top_layout = QtGui.QHBoxLayout()
+        self.show_hidden_cb = QtGui.QCheckBox("Show hidden files")
+        self.refresh_btn = QtGui.QPushButton()
+        self.refresh_btn.setIcon(self.style().standardIcon(QtGui.QStyle.SP_BrowserReload))
+        self.refresh_btn.setToolTip("Refresh files")
+        self.debug_btn = QtGui.QPushButton('Debug')
+        self.debug_btn.setToolTip('Operation timings and counters')
+        self.debug_panel = DebugPanel(self)
+        bottom_top_layout.addWidget(self.show_hidden_cb)
+        bottom_top_layout.addWidget(self.refresh_btn)
+        bottom_top_layout.addStretch()
+        bottom_top_layout.addWidget(self.debug_btn)
+        layout.addLayout(bottom_top_layout)
+
+        # File trees
+        files_layout = QtGui.QHBoxLayout()
+        self.local_tree = LocalTree(self)
+        self.remote_tree = RemoteTree(self)
+        for tree in (self.local_tree, self.remote_tree):
+            tree.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+            tree.customContextMenuRequested.connect(self.show_context_menu)
+        files_layout.addWidget(self.local_tree)
+        files_layout.addWidget(self.remote_tree)
+        layout.addLayout(files_layout)
+
+        # Transfer queue
+        self.transfer_queue = TransferQueue(self)
+        layout.addWidget(self.transfer_queue)
+
+        # Signals
+        self.connect_btn.clicked.connect(self.connect_sftp)
+        self.save_profile_btn.clicked.connect(self.save_profile)
+        self.refresh_btn.clicked.connect(lambda: self.refresh_all(force=True))
+        self.debug_btn.clicked.connect(self.debug_panel.show)
+        self.profile_box.currentIndexChanged.connect(lambda idx: self.load_profile(self.profile_box.currentText()))
+        self.show_hidden_cb.stateChanged.connect(self.toggle_show_hidden)
+        self.local_tree.doubleClicked.connect(self.local_item_double)
+        self.remote_tree.doubleClicked.connect(self.remote_item_double)
+        self.transfer_queue.job_finished.connect(self.transfer_finished)
+        self.transfer_queue.limits_changed.connect(self.apply_bandwidth)
+
+        self.load_profile(self.profile_box.currentText())
+        self.refresh_local()
+
+    # ---------- Profiles ----------
+    def load_profile(self, name):
+        if name in self.profiles:
+            p = self.profiles[name]
+            self.host_edit.setText(p.get('host', ''))
+            self.user_edit.setText(p.get('username', ''))
+            self.pass_edit.setText(p.get('password', ''))
+            tuning = p.get('tuning') or {}
+            self.auto_tune_cb.setChecked(bool(tuning.get('auto')))
+            compression = tuning.get('compression', False)
+            self.compression_box.setCurrentIndex(COMPRESSION_MODES.index(compression) if compression in COMPRESSION_MODES else 0)
+            self.verify_cb.setChecked(bool(p.get('verify')))
+            self.exec_cb.setChecked(bool(p.get('allow_exec')))
+
+    def current_profile(self):
+        # The selected profile, unless the fields now point at another server
+        p = self.profiles.get(str(self.profile_box.currentText()))
+        if p and p.get('host') == self.host_edit.text() and p.get('username') == self.user_edit.text():
+            return p
+        return {}
+
+    def current_tuning(self):
+        # Profile tuning with the Auto-tune and compression controls applied
+        tuning = dict(self.current_profile().get('tuning') or {})
+        tuning['auto'] = self.auto_tune_cb.isChecked()
+        tuning['compression'] = COMPRESSION_MODES[self.compression_box.currentIndex()]
+        return tuning
+
+    def current_verify(self):
+        # Hash algorithm for the Verify box, the profile's own if it names one
+        if not self.verify_cb.isChecked():
+            return None
+        verify = self.current_profile().get('verify')
+        return verify if verify and verify is not True else DEFAULT_VERIFY
+
+    def save_profile(self):
+        name, ok = QtGui.QInputDialog.getText(self, 'Save Profile', 'Enter profile name:')
+        if ok and name:
+            # Keeps settings edited by hand in the file, such as tuning
+            tuning = self.current_tuning()
+            profile = self.profiles.setdefault(str(name), {})
+            profile.update({
+                'host': self.host_edit.text(),
+                'username': self.user_edit.text(),
+                'password': self.pass_edit.text(),
+                'tuning': tuning,
+                'verify': self.current_verify(),
+                'allow_exec': self.exec_cb.isChecked()
+            })
+            save_profiles(self.profiles)
+            self.profile_box.clear()
+            self.profile_box.addItems(self.profiles.keys())
+            self.profile_box.setCurrentIndex(self.profile_box.findText(name))
+
+    # ---------- Connection ----------
+    def connect_sftp(self):
+        self.drop_idle_lister()
+        try:
+            self.sftp.allow_exec = self.exec_cb.isChecked()
+            self.sftp.archive = self.current_profile().get('archive')
+            self.sftp.verify = self.current_verify()
+            self.apply_bandwidth()
+            self.sftp.connect(
+                self.host_edit.text(),
+                22,
+                self.user_edit.text(),
+                self.pass_edit.text(),
+                self.current_tuning()
+            )
+            self.connected = True
+            QtGui.QMessageBox.information(self, "Connected", "SFTP connection successful.")
+            self.remote_path = "."
+            self.refresh_remote()
+        except Exception as e:
+            QtGui.QMessageBox.critical(self, "Connection Error", str(e))
+            self.connected = False
+
+    def drop_idle_lister(self):
+        # Gives the kept listing channel back to the pool
+        if self.idle_lister is not None:
+            try:
+                self.idle_lister.close()
+            except Exception:
+                pass
+            self.idle_lister = None
+
+    def apply_bandwidth(self):
+        # Profile limits and schedule, with the queue's limit boxes on top;
+        # running transfers pick the change up with their next block
+        self.sftp.bandwidth.configure(self.current_profile().get('bandwidth'), self.transfer_queue.limits())
+
+    # ---------- Refresh ----------
+    @instrumented('ui.refresh_all')
+    def refresh_all(self, force=False):
+        self.refresh_local(force)
+        if self.connected:
+            self.refresh_remote(force)
+
+    @instrumented('ui.refresh_local')
+    def refresh_local(self, force=False):
+        model = self.local_tree.model()
+        with_parent = os.path.dirname(self.local_path) != self.local_path
+        if self.local_listing:
+            self.local_listing.cancelled = True
+            self.local_listing = None
+        self.local_generation += 1
+
+        local_cache = self.sftp.local_cache
+        items = None if force else local_cache.listdir(self.local_path)
+        if items is not None:
+            if not self.show_hidden:
+                items = [i for i in items if not i.filename.startswith('.')]
+            model.set_entries([FileEntry(f.filename, f.st_size, f.st_mtime, stat.S_ISDIR(f.st_mode)) for f in items],
+                              with_parent)
+            return
+
+        # Not cached: scan on a worker so a slow disk or share can't freeze the window
+        model.set_entries([], with_parent)
+        self.local_listing = ListingThread(local_cache, self.local_path, force, self.show_hidden, self.local_generation,
+                                           self, 'ui.local_listing')
+        self.local_listing.page.connect(self.local_page)
+        self.local_listing.done.connect(self.local_listed)
+        self.local_listing.start()
+
+    def local_page(self, generation, entries):
+        if generation == self.local_generation:
+            self.local_tree.model().extend(entries)
+
+    def local_listed(self, generation, error):
+        thread = self.sender()
+        thread.wait()
+        thread.deleteLater()
+        if generation != self.local_generation:
+            return
+        self.local_listing = None
+        model = self.local_tree.model()
+        model.sort(model.sort_column, model.sort_order)
+        if error:
+            QtGui.QMessageBox.warning(self, "Error", "Cannot access local path: " + error)
+
+    @instrumented('ui.refresh_remote')
+    def refresh_remote(self, force=False):
+        if not self.connected:
+            return
+        model = self.remote_tree.model()
+        with_parent = self.remote_path not in ['.', '/']
+        if self.listing:
+            self.listing.cancelled = True
+            self.listing = None
+        self.listing_generation += 1
+
+        items = None if force else self.sftp.cache.listdir(self.remote_path)
+        if items is not None:
+            if not self.show_hidden:
+                items = [i for i in items if not i.filename.startswith('.')]
+            model.set_entries([FileEntry(f.filename, f.st_size, f.st_mtime, stat.S_ISDIR(f.st_mode)) for f in items],
+                              with_parent)
+            return
+
+        # Not cached: stream the listing in from a worker on its own channel
+        model.set_entries([], with_parent)
+        try:
+            lister = self.idle_lister or self.sftp.clone(browse=True)
+        except Exception as e:
+            QtGui.QMessageBox.warning(self, "Error", "Cannot access remote path: " + str(e))
+            return
+        self.idle_lister = None
+        self.listing = ListingThread(lister, self.remote_path, force, self.show_hidden, self.listing_generation, self)
+        self.listing.page.connect(self.remote_page)
+        self.listing.done.connect(self.remote_listed)
+        self.sftp.bandwidth.hold()
+        self.listing.start()
+
+    def remote_page(self, generation, entries):
+        if generation == self.listing_generation:
+            self.sftp.bandwidth.hold()
+            self.remote_tree.model().extend(entries)
+
+    def remote_listed(self, generation, error):
+        thread = self.sender()
+        thread.wait()
+        thread.deleteLater()
+        # Keep one listing channel around for the next uncached directory
+        if self.idle_lister is None and self.connected and thread.client.transport is self.sftp.transport:
+            self.idle_lister = thread.client
+        else:
+            thread.client.close()
+        if generation != self.listing_generation:
+            return
+        self.listing = None
+        model = self.remote_tree.model()
+        model.sort(model.sort_column, model.sort_order)
+        if error:
+            QtGui.QMessageBox.warning(self, "Error", "Cannot access remote path: " + error)
+
+    # ---------- Navigation ----------
+    def local_item_double(self, index):
+        name = self.local_tree.model().entry(index).name
+        if name == '..':
+            parent = os.path.dirname(self.local_path)
+            if os.path.exists(parent):
+                self.local_path = parent
+                self.refresh_local()
+            return
+        new_path = os.path.join(self.local_path, name)
+        if os.path.isdir(new_path):
+            self.local_path = new_path
+            self.refresh_local()
+
+    def remote_item_double(self, index):
+        name = self.remote_tree.model().entry(index).name
+        if name == '..':
+            if self.remote_path not in ['.', '/']:
+                parent = os.path.dirname(self.remote_path)
+                self.remote_path = parent if parent else '.'
+                self.refresh_remote()
+            return
+        new_path = self.remote_path + '/' + name
+        if self.sftp.is_dir(new_path):
+            self.remote_path = new_path
+            self.refresh_remote()
+
+    # ---------- Show Hidden Files ----------
+    def toggle_show_hidden(self, state):
+        self.show_hidden = (state == QtCore.Qt.Checked)
+        self.refresh_all()
+
+    # ---------- Delete Key ----------
+    def keyPressEvent(self, event):
+        if event.key() == QtCore.Qt.Key_Delete:
+            if self.local_tree.hasFocus():
+                item = self.local_tree.current_entry()
+                if item:
+                    self.delete_item(self.local_tree, item)
+            elif self.remote_tree.hasFocus():
+                item = self.remote_tree.current_entry()
+                if item:
+                    self.delete_item(self.remote_tree, item)
+
+    # ---------- Context Menu ----------
+    def show_context_menu(self, pos):
+        tree = self.sender()
+        item = tree.entry_at(pos)
+        menu = QtGui.QMenu()
+
+        if item and item.name != '..':
+            delete_action = menu.addAction("Delete")
+            rename_action = menu.addAction("Rename")
+            if tree == self.remote_tree:
+                download_action = menu.addAction("Download")
+                sync_action = menu.addAction("Sync to Local")
+            else:
+                upload_action = menu.addAction("Upload")
+                sync_action = menu.addAction("Sync to Remote")
+        else:
+            create_folder_action = menu.addAction("Create Folder")
+
+        action = menu.exec_(tree.mapToGlobal(pos))
+
+        if item and item.name != '..':
+            if action == delete_action:
+                self.delete_item(tree, item)
+            elif action == rename_action:
+                self.rename_item(tree, item)
+            elif tree == self.remote_tree and action == download_action:
+                self.download_item(item)
+            elif tree == self.local_tree and action == upload_action:
+                self.upload_item(item)
+            elif action == sync_action:
+                self.sync_item(tree, item)
+        else:
+            if not item and action == create_folder_action:
+                self.create_folder(tree)
+
+    # ---------- File Operations ----------
+    def delete_item(self, tree, item):
+        name = item.name
+        if tree == self.local_tree:
+            path = os.path.join(self.local_path, name)
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except Exception as e:
+                QtGui.QMessageBox.warning(self, "Error", str(e))
+            self.refresh_local()
+        else:
+            path = self.remote_path + '/' + name
+            if item.is_dir:
+                # Large trees take a while even pipelined, run it as a job
+                self.transfer_queue.enqueue('remove_tree', (path,), 'Delete ' + path, 'remote', 'entries')
+                return
+            try:
+                self.sftp.remove(path)
+            except Exception as e:
+                QtGui.QMessageBox.warning(self, "Error", str(e))
+            self.refresh_remote()
+
+    def rename_item(self, tree, item):
+        old_name = item.name
+        new_name, ok = QtGui.QInputDialog.getText(self, "Rename", "New name:", text=old_name)
+        if not ok or not new_name or new_name == old_name:
+            return
+        if tree == self.local_tree:
+            old_path = os.path.join(self.local_path, old_name)
+            new_path = os.path.join(self.local_path, new_name)
+            try:
+                os.rename(old_path, new_path)
+            except Exception as e:
+                QtGui.QMessageBox.warning(self, "Rename Error", str(e))
+            self.refresh_local()
+        else:
+            old_path = self.remote_path + '/' + old_name
+            new_path = self.remote_path + '/' + new_name
+            try:
+                self.sftp.rename(old_path, new_path)
+            except Exception as e:
+                QtGui.QMessageBox.warning(self, "Rename Error", str(e))
+            self.refresh_remote()
+
+    def create_folder(self, tree):
+        name, ok = QtGui.QInputDialog.getText(self, "Create Folder", "Folder name:")
+        if not ok or not name:
+            return
+        if tree == self.local_tree:
+            path = os.path.join(self.local_path, name)
+            try:
+                os.makedirs(path)
+            except Exception as e:
+                QtGui.QMessageBox.warning(self, "Error", str(e))
+            self.refresh_local()
+        else:
+            path = self.remote_path + '/' + name
+            try:
+                self.sftp.mkdir(path)
+            except Exception as e:
+                QtGui.QMessageBox.warning(self, "Error", str(e))
+            self.refresh_remote()
+
+    # ---------- Upload/Download helpers ----------
+    def transfer_finished(self, task):
+        if task.method == 'plan_sync':
+            # Asked once the queue has moved on to its next task
+            QtCore.QTimer.singleShot(0, lambda: self.confirm_sync(task))
+            return
+        # Overwritten files leave their directory's mtime alone, so the
+        # local side is rescanned rather than trusted from the cache
+        if task.refresh == 'local':
+            self.refresh_local(force=True)
+        else:
+            self.refresh_remote()
+
+    def upload_item(self, item):
+        path = os.path.join(self.local_path, item.name)
+        remote_path = self.remote_path + '/' + item.name
+        self.transfer_queue.enqueue('upload', (path, remote_path), 'Upload ' + path, 'remote')
+
+    def download_item(self, item):
+        remote_path = self.remote_path + '/' + item.name
+        local_path = os.path.join(self.local_path, item.name)
+        self.transfer_queue.enqueue('download', (remote_path, local_path), 'Download ' + remote_path, 'local')
+
+    def sync_item(self, tree, item):
+        name = item.name
+        local_path = os.path.join(self.local_path, name)
+        remote_path = self.remote_path + '/' + name
+        direction = 'put' if tree == self.local_tree else 'get'
+        # Comparing walks both trees (and may hash them), so the plan is
+        # built on the queue and confirmed in confirm_sync
+        label = 'Compare ' + (local_path if direction == 'put' else remote_path)
+        self.transfer_queue.enqueue('plan_sync', (local_path, remote_path, direction), label, None, None)
+
+    def confirm_sync(self, task):
+        if task.error:
+            QtGui.QMessageBox.warning(self, "Sync Error", task.error)
+            return
+        plan = task.result
+        if plan.is_empty():
+            QtGui.QMessageBox.information(self, "Sync", "Already in sync. " + plan.summary())
+            return
+        reply = QtGui.QMessageBox.question(self, "Sync", plan.report(limit=20) + "\n\nProceed?",
+                                           QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
+        if reply != QtGui.QMessageBox.Yes:
+            return
+        direction = plan.direction
+        label = 'Sync ' + (plan.local if direction == 'put' else plan.remote)
+        self.transfer_queue.enqueue('execute_sync', (plan,), label, 'remote' if direction == 'put' else 'local')
+
+    def closeEvent(self, event):
+        self.transfer_queue.shutdown()
+        self.drop_idle_lister()
+        connection_pool.close_all()
+        event.accept()
+
+# ---------------- Run ----------------
+def run(argv):
+    if os.environ.get('XPFTP_TRACE'):
+        metrics.trace_to(os.environ['XPFTP_TRACE'])
+    app = QtGui.QApplication(argv)
+    window = MainWindow()
+    window.show()
+    return app.exec_()